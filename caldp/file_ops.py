@@ -1,15 +1,23 @@
 import sys
 import os
 import glob
+import functools
 import shutil
+import stat
 import tarfile
+import subprocess
 import boto3
+from boto3.s3.transfer import TransferConfig
 import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from caldp import process
 from caldp import log
 from caldp import exit_codes
 from caldp import sysexit
 
+MB = 1024 ** 2
+
 
 def get_input_path(input_uri, ipppssoot, make=False):
     """Fetches the path to input files"""
@@ -66,53 +74,211 @@ def get_input_dir(input_uri):
     return input_dir
 
 
-def find_output_files(ipppssoot):
-    search_fits = f"{ipppssoot}/*.fits"
-    search_tra = f"{ipppssoot}/*.tra"
-    output_files = list(glob.glob(search_fits))
-    output_files.extend(list(glob.glob(search_tra)))
-    return output_files
+def find_output_files(ipppssoot, base_dir=""):
+    """Return the .fits and .tra files in `base_dir`/`ipppssoot`."""
+    try:
+        with os.scandir(os.path.join(base_dir, ipppssoot)) as entries:
+            return [
+                e.path
+                for e in entries
+                if e.name.endswith((".fits", ".tra")) and not e.name.startswith(".") and e.is_file()
+            ]
+    except (FileNotFoundError, NotADirectoryError):
+        return []
 
 
-def find_previews(ipppssoot, output_files):
-    search_prev = f"{ipppssoot}/previews/*"
-    output_files.extend(list(glob.glob(search_prev)))
+def find_previews(ipppssoot, output_files, base_dir=""):
+    """Add the contents of `base_dir`/`ipppssoot`/previews, if any, to `output_files`."""
+    try:
+        with os.scandir(os.path.join(base_dir, ipppssoot, "previews")) as entries:
+            output_files.extend(e.path for e in entries if not e.name.startswith("."))
+    except (FileNotFoundError, NotADirectoryError):
+        pass  # no previews
     return output_files
 
 
-def find_input_files(ipppssoot):
+def find_input_files(ipppssoot, base_dir=""):
     """If job fails (no outputs), tar the input files instead for debugging purposes."""
-    search_inputs = f"{ipppssoot}/*"
-    file_list = list(glob.glob(search_inputs))
-    return file_list
+    tar = ipppssoot + ".tar.gz"  # left over from a previous attempt
+    try:
+        with os.scandir(os.path.join(base_dir, ipppssoot)) as entries:
+            return [e.path for e in entries if not e.name.startswith(".") and e.name != tar]
+    except (FileNotFoundError, NotADirectoryError):
+        return []
 
 
-def make_tar(file_list, ipppssoot):
+def make_tar(file_list, ipppssoot, base_dir=""):
+    """Create `base_dir`/`ipppssoot`/`ipppssoot`.tar.gz from `file_list`,  naming
+    each member relative to `base_dir` (ipst is parent dir) so no chdir is needed.
+    """
     tar = ipppssoot + ".tar.gz"
-    log.info("Creating tarfile: ", tar)
-    if os.path.exists(tar):
-        os.remove(tar)  # clean up from prev attempts
-    with tarfile.open(tar, "x:gz") as t:
-        for f in file_list:
-            print(os.path.basename(f))
-            t.add(f)
-    log.info("Tar successful: ", tar)
-    tar_dest = os.path.join(ipppssoot, tar)
-    shutil.copy(tar, ipppssoot)  # move tarfile to outputs/{ipst}
-    os.remove(tar)
+    tar_dest = os.path.join(base_dir, ipppssoot, tar)  # write tarfile directly to outputs/{ipst}
+    log.info("Creating tarfile: ", tar_dest)
+    if os.path.exists(tar_dest):
+        os.remove(tar_dest)  # clean up from prev attempts
+    tar_path = os.path.abspath(tar_dest)
+    file_list = [f for f in file_list if os.path.abspath(f) != tar_path]  # never add the tarball to itself
+    pigz = shutil.which("pigz")
+    try:
+        if pigz:  # parallel gzip:  stream the tar through pigz using every available core
+            pigz_tar(pigz, tar_dest, file_list, base_dir)
+        else:
+            with tarfile.open(tar_dest, "x:gz") as t:
+                add_files(t, file_list, base_dir)
+    except BaseException:
+        if os.path.exists(tar_dest):
+            os.remove(tar_dest)  # don't leave a partial tarball behind
+        raise
+    log.info("Tar successful: ", tar_dest)
     return tar_dest
 
 
+def available_cpus():
+    """Return the number of CPUs this process may run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def pigz_tar(pigz, tar_dest, file_list, base_dir=""):
+    """Stream a tar of `file_list` through the `pigz` executable into `tar_dest`.
+    Raises sysexit.SubprocessFailure if pigz exits non-zero or stops reading early.
+    """
+    broken_pipe = False
+    with open(tar_dest, "xb") as out:
+        proc = subprocess.Popen([pigz, "-p", str(available_cpus())], stdin=subprocess.PIPE, stdout=out)
+        try:
+            with tarfile.open(mode="w|", fileobj=proc.stdin) as t:
+                add_files(t, file_list, base_dir)
+            proc.stdin.close()
+        except BrokenPipeError:
+            broken_pipe = True  # pigz died,  report its returncode below
+        finally:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                broken_pipe = True
+            proc.wait()
+    if proc.returncode or broken_pipe:
+        raise sysexit.SubprocessFailure(proc.returncode)
+
+
+def add_files(t, file_list, base_dir=""):
+    """Add `file_list` to open tarfile `t`.  Regular files get a TarInfo built from a
+    single lstat,  skipping TarFile.add's recursion and uid/gid name lookups;
+    directories and links still go through add() so their contents are kept.
+    """
+    for f in file_list:
+        print(os.path.basename(f))
+        arcname = os.path.relpath(f, base_dir or os.curdir)
+        st = os.lstat(f)
+        if stat.S_ISREG(st.st_mode):
+            info = tarfile.TarInfo(arcname)
+            info.size, info.mtime, info.mode = st.st_size, st.st_mtime, stat.S_IMODE(st.st_mode)
+            info.uid, info.gid = st.st_uid, st.st_gid
+            with open(f, "rb") as fileobj:
+                if hasattr(os, "posix_fadvise"):  # widen kernel readahead while the member is compressed
+                    os.posix_fadvise(fileobj.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                t.addfile(info, fileobj)
+        else:
+            t.add(f, arcname=arcname)
+
+
+_S3_CLIENT = None
+_S3_LOCK = threading.Lock()  # guards lazy creation of the shared client and config
+_TRANSFER_CONFIG = None
+
+
+def get_s3_client():
+    """Return a process-wide boto3 S3 client,  created on first use.  boto3 clients
+    are thread-safe so the same client is shared by concurrent tar_outputs calls.
+    """
+    global _S3_CLIENT
+    with _S3_LOCK:
+        if _S3_CLIENT is None:
+            _S3_CLIENT = boto3.session.Session().client("s3")
+    return _S3_CLIENT
+
+
+def get_transfer_config():
+    """Return the S3 multipart TransferConfig, sized by CALDP_S3_CHUNK_MB and
+    CALDP_S3_CONCURRENCY.  Large chunks keep multi-GB tarballs to few parts.
+    """
+    global _TRANSFER_CONFIG
+    with _S3_LOCK:
+        if _TRANSFER_CONFIG is None:
+            chunk_mb = int(os.environ.get("CALDP_S3_CHUNK_MB", 256))
+            concurrency = int(os.environ.get("CALDP_S3_CONCURRENCY", 10))
+            log.info(f"S3 transfer config: threshold=128 MB chunksize={chunk_mb} MB concurrency={concurrency}")
+            _TRANSFER_CONFIG = TransferConfig(
+                multipart_threshold=128 * MB,
+                multipart_chunksize=chunk_mb * MB,
+                max_concurrency=concurrency,
+                use_threads=True,
+            )
+    return _TRANSFER_CONFIG
+
+
+@functools.lru_cache()
+def parse_s3_uri(s3_uri):
+    """Split `s3_uri` into its bucket and object prefix.
+
+    >>> parse_s3_uri("s3://caldp-output-test/outputs/j8cb010b0")
+    ('caldp-output-test', 'outputs/j8cb010b0')
+    """
+    if not s3_uri.startswith("s3://"):
+        raise ValueError(f"Not an S3 URI: {repr(s3_uri)}")
+    bucket, _, prefix = s3_uri[5:].partition("/")
+    return bucket, prefix
+
+
 def upload_tar(tar, output_path):
     with sysexit.exit_on_exception(exit_codes.S3_UPLOAD_ERROR, "S3 tar upload of", tar, "to", output_path, "FAILED."):
-        client = boto3.client("s3")
-        parts = output_path[5:].split("/")
-        bucket, prefix = parts[0], "/".join(parts[1:])
-        objectname = prefix + "/" + os.path.basename(tar)
-        log.info(f"Uploading: s3://{bucket}/{objectname}")
         if output_path.startswith("s3"):
-            with open(tar, "rb") as f:
-                client.upload_fileobj(f, bucket, objectname, Callback=ProgressPercentage(tar))
+            client = get_s3_client()
+            bucket, prefix = parse_s3_uri(output_path)
+            objectname = prefix + "/" + os.path.basename(tar)
+            log.info(f"Uploading: s3://{bucket}/{objectname}")
+            client.upload_file(tar, bucket, objectname, Config=get_transfer_config(), Callback=ProgressPercentage(tar))
+
+
+def upload_files(file_list, output_path, ipppssoot, base_dir="", workers=8):
+    """Upload each of `file_list` directly to `output_path`,  keeping its path
+    relative to `base_dir`/`ipppssoot` (e.g. previews/),  using `workers` threads.
+    """
+    with sysexit.exit_on_exception(
+        exit_codes.S3_UPLOAD_ERROR, "S3 upload of", ipppssoot, "outputs to", output_path, "FAILED."
+    ):
+        client = get_s3_client()
+        bucket, prefix = parse_s3_uri(output_path)
+        ipst_dir = os.path.join(base_dir, ipppssoot)
+
+        def _upload(filepath):
+            objectname = prefix + "/" + os.path.relpath(filepath, ipst_dir)
+            log.info(f"Uploading: s3://{bucket}/{objectname}")
+            client.upload_file(filepath, bucket, objectname, Config=get_transfer_config())
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(_upload, file_list))
+
+
+def direct_upload_threshold():
+    """Total output size in bytes below which S3 outputs are uploaded as individual
+    files rather than a tarball,  set by CALDP_S3_DIRECT_UPLOAD_MB.  Defaults to 0,
+    always tar,  since downstream consumers expect {ipst}.tar.gz.
+    """
+    return int(os.environ.get("CALDP_S3_DIRECT_UPLOAD_MB", 0)) * MB
+
+
+def is_small_output_set(file_list, threshold):
+    """Return True if `file_list` holds only regular files totalling under `threshold` bytes."""
+    total = 0
+    for f in file_list:
+        st = os.lstat(f)
+        total += st.st_size
+        if not stat.S_ISREG(st.st_mode) or total >= threshold:
+            return False
+    return True
 
 
 class ProgressPercentage(object):
@@ -120,18 +286,41 @@ class ProgressPercentage(object):
         self._filename = filename
         self._size = float(os.path.getsize(filename))
         self._seen_so_far = 0
+        self._last_percentage = -1.0
+        self._last_time = 0.0
+        self._sequence = 0  # numbers accepted updates so stale ones can be dropped
+        self._written = 0
         self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
 
     def __call__(self, bytes_amount):
         # To simplify, assume this is hooked up to a single filename
+        # Only the counters are updated under the lock;  formatting and output happen outside it.
         with self._lock:
             self._seen_so_far += bytes_amount
-            percentage = (self._seen_so_far / self._size) * 100
-            sys.stdout.write("\r%s  %s / %s  (%.2f%%)" % (self._filename, self._seen_so_far, self._size, percentage))
-            sys.stdout.flush()
+            seen = self._seen_so_far
+            percentage = (seen / self._size) * 100
+            now = time.monotonic()
+            # Throttle to ~1% or 250 ms steps so upload threads don't serialize on output.
+            if seen < self._size and percentage - self._last_percentage < 1.0 and now - self._last_time <= 0.25:
+                return
+            self._last_percentage, self._last_time = percentage, now
+            self._sequence += 1
+            sequence = self._sequence
+        line = f"\r{self._filename}  {seen} / {self._size}  ({percentage:.2f}%)"
+        # Intermediate updates are dropped if another thread is writing;  the final one waits.
+        if self._write_lock.acquire(blocking=seen >= self._size):
+            try:
+                if sequence > self._written:
+                    self._written = sequence
+                    sys.stderr.write(line)
+                    if sys.stderr.isatty():
+                        sys.stderr.flush()
+            finally:
+                self._write_lock.release()
 
 
-def clean_up(file_list, ipppssoot, dirs=None):
+def clean_up(file_list, ipppssoot, dirs=None, base_dir=""):
     print("\nCleaning up...")
     for f in file_list:
         try:
@@ -140,7 +329,7 @@ def clean_up(file_list, ipppssoot, dirs=None):
             print(f"file {f} not found")
     if dirs is not None:
         for d in dirs:
-            subdir = os.path.abspath(f"{ipppssoot}/{d}")
+            subdir = os.path.abspath(os.path.join(base_dir, ipppssoot, d))
             try:
                 shutil.rmtree(subdir)
             except OSError:
@@ -149,22 +338,41 @@ def clean_up(file_list, ipppssoot, dirs=None):
 
 
 def tar_outputs(ipppssoot, input_uri, output_uri):
-    working_dir = os.getcwd()
     output_path = process.get_output_path(output_uri, ipppssoot)
-    output_dir = get_output_dir(output_uri)
-    os.chdir(output_dir)  # create tarfile with ipst/*fits (ipst is parent dir)
-    output_files = find_output_files(ipppssoot)
+    base_dir = os.path.abspath(get_output_dir(output_uri))  # create tarfile with ipst/*fits (ipst is parent dir)
+    output_files = find_output_files(ipppssoot, base_dir)
     if len(output_files) == 0:
         log.info("No output files found. Tarring inputs for debugging.")
-        os.chdir(working_dir)
-        input_dir = get_input_dir(input_uri)
-        os.chdir(input_dir)
-        file_list = find_input_files(ipppssoot)
+        base_dir = os.path.abspath(get_input_dir(input_uri))
+        file_list = find_input_files(ipppssoot, base_dir)
     else:
-        file_list = find_previews(ipppssoot, output_files)
-    tar = make_tar(file_list, ipppssoot)
-    upload_tar(tar, output_path)
-    clean_up(file_list, ipppssoot, dirs=["previews", "env"])
-    os.chdir(working_dir)
+        file_list = find_previews(ipppssoot, output_files, base_dir)
+    tar = None
+    threshold = direct_upload_threshold()
+    if (
+        threshold > 0
+        and output_path.startswith("s3")
+        and len(output_files) > 0
+        and is_small_output_set(file_list, threshold)
+    ):
+        log.info("Small output set. Uploading files without tarring.")
+        upload_files(file_list, output_path, ipppssoot, base_dir)
+    else:
+        tar = make_tar(file_list, ipppssoot, base_dir)
+        upload_tar(tar, output_path)
+    clean_up(file_list, ipppssoot, dirs=["previews", "env"], base_dir=base_dir)
     if output_uri.startswith("file"):  # test cov only
         return tar, file_list  # , local_outpath
+
+
+def tar_outputs_many(ipppssoots, input_uri, output_uri, workers=4):
+    """Tar and upload the outputs of several `ipppssoots` concurrently.  Since
+    tar_outputs never changes the cwd, each dataset can run in its own thread.
+    Returns the list of tar_outputs results in `ipppssoots` order.
+    """
+
+    def _tar_outputs(ipppssoot):
+        return tar_outputs(ipppssoot, input_uri, output_uri)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_tar_outputs, ipppssoots))
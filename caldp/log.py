@@ -98,14 +98,23 @@ class CaldpLogger:
         # verbose_level handles CALDP verbosity,  defaulting to 0 for no debug
         try:
             verbose_level = os.environ.get("CALDP_VERBOSITY", 0)
-            self.verbose_level = int(verbose_level)
+            self._set_verbose_level(int(verbose_level))
         except Exception:
             warning(
                 "Bad format for CALDP_VERBOSITY =",
                 repr(verbose_level),
                 "Use e.g. -1 to squelch info, 0 for no debug,  " "50 for default debug output. 100 max debug.",
             )
-            self.verbose_level = DEFAULT_VERBOSITY_LEVEL
+            self._set_verbose_level(DEFAULT_VERBOSITY_LEVEL)
+
+    def _set_verbose_level(self, level):
+        """Set verbose_level and precompute which message types it enables so
+        suppressed messages return before any formatting is done.
+        """
+        self.verbose_level = level
+        self._info_enabled = level > -1
+        self._warn_enabled = level > -2
+        self._error_enabled = level > -3
 
     def set_formatter(self, enable_time=True):
         """Set the formatter attribute of `self` to a logging.Formatter and return it."""
@@ -129,31 +138,44 @@ class CaldpLogger:
             self.write()
         return self.format(*args, **keys)
 
+    def log_fast(self, level, *args):
+        """Log `args` space separated,  deferring str() of each until a handler
+        actually emits the record.
+        """
+        self.logger.log(level, " ".join(["%s"] * len(args)), *args)
+
+    def _log(self, level, args, keys):
+        if self.filters or self.eol_pending or "sep" in keys:
+            self.logger.log(level, self.eformat(*args, **keys))
+        else:
+            self.log_fast(level, *args)
+
     def info(self, *args, **keys):
         self.infos += 1
-        if self.verbose_level > -1:
-            self.logger.info(self.eformat(*args, **keys))
+        if self._info_enabled:
+            self._log(logging.INFO, args, keys)
 
     def warn(self, *args, **keys):
         self.warnings += 1
-        if self.verbose_level > -2:
-            self.logger.warning(self.eformat(*args, **keys))
+        if self._warn_enabled:
+            self._log(logging.WARNING, args, keys)
 
     def error(self, *args, **keys):
         self.errors += 1
-        if self.verbose_level > -3:
-            self.logger.error(self.eformat(*args, **keys))
+        if self._error_enabled:
+            self._log(logging.ERROR, args, keys)
 
     def debug(self, *args, **keys):
         self.debugs += 1
-        self.logger.debug(self.eformat(*args, **keys))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self._log(logging.DEBUG, args, keys)
 
     def should_output(self, *args, **keys):
         verbosity = keys.get("verbosity", DEFAULT_VERBOSITY_LEVEL)
         return not self.verbose_level < verbosity
 
     def verbose(self, *args, **keys):
-        if self.should_output(*args, **keys):
+        if self.verbose_level >= keys.get("verbosity", DEFAULT_VERBOSITY_LEVEL):
             self.debug(*args, **keys)
 
     def verbose_warning(self, *args, **keys):
@@ -183,7 +205,7 @@ class CaldpLogger:
             level = DEFAULT_VERBOSITY_LEVEL
         elif level is False:
             level = 0
-        self.verbose_level = level
+        self._set_verbose_level(level)
         return old_verbose
 
     def get_verbose(self):
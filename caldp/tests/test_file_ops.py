@@ -0,0 +1,228 @@
+"""This module defines unit tests for file_ops.py tarring and upload helpers which
+run against small synthetic datasets and need no HST data or S3 access.
+"""
+import os
+import stat
+import tarfile
+import threading
+
+import pytest
+
+from caldp import file_ops
+from caldp import sysexit
+
+
+# ----------------------------------------------------------------------------------------
+
+
+def make_outputs(base_dir, ipppssoot, previews=True):
+    """Create fake output files for `ipppssoot` under `base_dir` and return
+    the expected tar member names.
+    """
+    ipst_dir = os.path.join(base_dir, ipppssoot)
+    os.makedirs(ipst_dir)
+    names = [f"{ipppssoot}_raw.fits", f"{ipppssoot}_flt.fits", f"{ipppssoot}.tra"]
+    if previews:
+        os.makedirs(os.path.join(ipst_dir, "previews"))
+        names.append(f"previews/{ipppssoot}_flt.png")
+    for name in names:
+        with open(os.path.join(ipst_dir, name), "wb") as f:
+            f.write(os.urandom(256 * 1024))
+    return sorted(f"{ipppssoot}/{name}" for name in names)
+
+
+def tar_members(tar):
+    with tarfile.open(tar) as t:
+        return sorted(t.getnames())
+
+
+def install_pigz(tmpdir, monkeypatch, script):
+    """Put a stub `pigz` running shell `script` first on PATH."""
+    bin_dir = tmpdir.mkdir("bin")
+    pigz = bin_dir.join("pigz")
+    pigz.write("#!/bin/sh\n" + script + "\n")
+    os.chmod(str(pigz), stat.S_IRWXU)
+    monkeypatch.setenv("PATH", str(bin_dir) + os.pathsep + os.environ["PATH"])
+
+
+# ----------------------------------------------------------------------------------------
+
+
+def make_stale_tar(tmpdir, ipppssoot):
+    """Create a failed job's inputs with a tarball left over from an earlier run,
+    returning the inputs dir and the expected tar member names.
+    """
+    input_dir = str(tmpdir.mkdir("inputs"))
+    os.makedirs(os.path.join(input_dir, ipppssoot))
+    for name in [f"{ipppssoot}_asn.fits", f"{ipppssoot}.tar.gz"]:
+        with open(os.path.join(input_dir, ipppssoot, name), "wb") as f:
+            f.write(os.urandom(256 * 1024))
+    return input_dir, [f"{ipppssoot}/{ipppssoot}_asn.fits"]
+
+
+def test_tar_outputs_stale_input_tarball(tmpdir, monkeypatch):
+    monkeypatch.setattr(file_ops.shutil, "which", lambda name: None)  # x:gz fallback
+    input_dir, expected = make_stale_tar(tmpdir, "j8cb010b0")
+    tar, file_list = file_ops.tar_outputs("j8cb010b0", "file:" + input_dir, "file:" + str(tmpdir.mkdir("outputs")))
+    assert tar == os.path.join(input_dir, "j8cb010b0", "j8cb010b0.tar.gz")
+    assert tar_members(tar) == expected
+
+
+def test_make_tar_skips_itself(tmpdir, monkeypatch):
+    monkeypatch.setattr(file_ops.shutil, "which", lambda name: None)  # x:gz fallback
+    input_dir, expected = make_stale_tar(tmpdir, "j8cb010b0")
+    file_list = [
+        os.path.join(input_dir, "j8cb010b0", name) for name in os.listdir(os.path.join(input_dir, "j8cb010b0"))
+    ]
+    tar = file_ops.make_tar(file_list, "j8cb010b0", input_dir)
+    assert tar_members(tar) == expected
+
+
+def test_make_tar_pigz(tmpdir, monkeypatch):
+    install_pigz(tmpdir, monkeypatch, "exec gzip -c")
+    base_dir = str(tmpdir.mkdir("outputs"))
+    expected = make_outputs(base_dir, "j8cb010b0")
+    file_list = file_ops.find_previews("j8cb010b0", file_ops.find_output_files("j8cb010b0", base_dir), base_dir)
+    tar = file_ops.make_tar(file_list, "j8cb010b0", base_dir)
+    assert tar == os.path.join(base_dir, "j8cb010b0", "j8cb010b0.tar.gz")
+    assert tar_members(tar) == expected
+
+
+def test_make_tar_pigz_failure(tmpdir, monkeypatch):
+    install_pigz(tmpdir, monkeypatch, "exit 3")
+    base_dir = str(tmpdir.mkdir("outputs"))
+    make_outputs(base_dir, "j8cb010b0")
+    file_list = file_ops.find_output_files("j8cb010b0", base_dir)
+    with pytest.raises(sysexit.SubprocessFailure) as excinfo:
+        file_ops.make_tar(file_list, "j8cb010b0", base_dir)
+    assert excinfo.value.returncode == 3
+    assert not os.path.exists(os.path.join(base_dir, "j8cb010b0", "j8cb010b0.tar.gz"))
+
+
+def test_progress_percentage_throttled(tmpdir, capsys):
+    upload = tmpdir.join("upload.tar.gz")
+    upload.write_binary(b"x" * 100000)
+    progress = file_ops.ProgressPercentage(str(upload))
+    for _ in range(1000):
+        progress(100)
+    captured = capsys.readouterr()
+    updates = [line for line in captured.err.split("\r") if line]
+    assert captured.out == ""
+    assert len(updates) <= 110  # ~1% steps,  not one per callback
+    assert updates[-1].endswith("100000 / 100000.0  (100.00%)")
+
+
+def test_progress_percentage_threads(tmpdir, capsys):
+    upload = tmpdir.join("upload.tar.gz")
+    upload.write_binary(b"x" * 100000)
+    progress = file_ops.ProgressPercentage(str(upload))
+
+    def send_chunks():
+        for _ in range(1000):
+            progress(10)
+
+    threads = [threading.Thread(target=send_chunks) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    updates = [line for line in capsys.readouterr().err.split("\r") if line]
+    assert len(updates) <= 110
+    assert updates[-1].endswith("100000 / 100000.0  (100.00%)")
+    assert updates == sorted(updates, key=lambda line: int(line.split()[1]))  # never goes backwards
+
+
+def test_tar_outputs_many(tmpdir):
+    base_dir = str(tmpdir.mkdir("outputs"))
+    ipppssoots = ["j8cb010b0", "obes03010", "la8q99030"]
+    expected = {ipppssoot: make_outputs(base_dir, ipppssoot) for ipppssoot in ipppssoots}
+    working_dir = os.getcwd()
+    results = file_ops.tar_outputs_many(ipppssoots, "file:" + str(tmpdir.join("inputs")), "file:" + base_dir)
+    assert os.getcwd() == working_dir
+    assert len(results) == len(ipppssoots)
+    for ipppssoot, (tar, file_list) in zip(ipppssoots, results):
+        assert tar == os.path.join(base_dir, ipppssoot, ipppssoot + ".tar.gz")
+        assert len(file_list) == len(expected[ipppssoot])
+        assert tar_members(tar) == expected[ipppssoot]
+
+
+class StubS3Client:
+    """Records upload_file() calls as (filename, bucket, key) tuples."""
+
+    def __init__(self):
+        self.uploads = []
+
+    def upload_file(self, filename, bucket, key, **keys):
+        self.uploads.append((filename, bucket, key))
+
+
+@pytest.fixture
+def s3_client(monkeypatch):
+    client = StubS3Client()
+    monkeypatch.setattr(file_ops, "_S3_CLIENT", client)
+    return client
+
+
+def test_upload_files_keys(tmpdir, s3_client):
+    base_dir = str(tmpdir.mkdir("outputs"))
+    expected = make_outputs(base_dir, "j8cb010b0")
+    file_list = [os.path.join(base_dir, name) for name in expected]
+    file_ops.upload_files(file_list, "s3://caldp-output-test/outputs/j8cb010b0", "j8cb010b0", base_dir)
+    assert sorted(s3_client.uploads) == sorted(
+        (os.path.join(base_dir, name), "caldp-output-test", "outputs/" + name) for name in expected
+    )
+
+
+def test_tar_outputs_s3_direct_upload(tmpdir, monkeypatch, s3_client):
+    monkeypatch.chdir(tmpdir)
+    monkeypatch.setenv("CALDP_S3_DIRECT_UPLOAD_MB", "2")
+    expected = make_outputs("outputs", "j8cb010b0")
+    file_ops.tar_outputs("j8cb010b0", "file:inputs", "s3://caldp-output-test/outputs")
+    keys = sorted(key for (_, _, key) in s3_client.uploads)
+    assert keys == ["outputs/" + name for name in expected]
+    assert not os.path.exists(os.path.join("outputs", "j8cb010b0", "j8cb010b0.tar.gz"))
+
+
+@pytest.mark.parametrize("direct_mb, link", [(None, False), ("1", False), ("2", True)])
+def test_tar_outputs_s3_tarball(tmpdir, monkeypatch, s3_client, direct_mb, link):
+    """Outputs are tarred by default, when at or over the threshold, or when
+    previews/ holds something other than regular files.
+    """
+    monkeypatch.chdir(tmpdir)
+    if direct_mb is None:
+        monkeypatch.delenv("CALDP_S3_DIRECT_UPLOAD_MB", raising=False)
+    else:
+        monkeypatch.setenv("CALDP_S3_DIRECT_UPLOAD_MB", direct_mb)
+    expected = make_outputs("outputs", "j8cb010b0")
+    if link:
+        os.symlink("j8cb010b0_flt.png", os.path.join("outputs", "j8cb010b0", "previews", "j8cb010b0_link.png"))
+        expected = sorted(expected + ["j8cb010b0/previews/j8cb010b0_link.png"])
+    file_ops.tar_outputs("j8cb010b0", "file:inputs", "s3://caldp-output-test/outputs")
+    tar = os.path.abspath(os.path.join("outputs", "j8cb010b0", "j8cb010b0.tar.gz"))
+    assert s3_client.uploads == [(tar, "caldp-output-test", "outputs/j8cb010b0/j8cb010b0.tar.gz")]
+    assert tar_members(tar) == expected
+
+
+def test_find_files_missing_dirs(tmpdir):
+    base_dir = str(tmpdir)
+    assert file_ops.find_output_files("j8cb010b0", base_dir) == []
+    assert file_ops.find_input_files("j8cb010b0", base_dir) == []
+    assert file_ops.find_previews("j8cb010b0", [], base_dir) == []
+
+
+def test_make_tar_pigz_skips_itself(tmpdir, monkeypatch):
+    install_pigz(tmpdir, monkeypatch, "exec gzip -c")
+    input_dir, expected = make_stale_tar(tmpdir, "j8cb010b0")
+    file_list = [
+        os.path.join(input_dir, "j8cb010b0", name) for name in os.listdir(os.path.join(input_dir, "j8cb010b0"))
+    ]
+    tar = file_ops.make_tar(file_list, "j8cb010b0", input_dir)
+    assert tar_members(tar) == expected
+
+
+def test_find_output_files_skips_dotfiles(tmpdir):
+    base_dir = str(tmpdir.mkdir("outputs"))
+    expected = make_outputs(base_dir, "j8cb010b0", previews=False)
+    tmpdir.join("outputs", "j8cb010b0", "._j8cb010b0_raw.fits").write("resource fork")
+    found = file_ops.find_output_files("j8cb010b0", base_dir)
+    assert sorted(os.path.relpath(f, base_dir) for f in found) == expected